@@ -1,9 +1,14 @@
-from fastapi import FastAPI, APIRouter, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, APIRouter, BackgroundTasks, File, UploadFile, HTTPException, Form
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
 import os
+import asyncio
 import logging
+import re
+import time
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional
@@ -11,20 +16,105 @@ import uuid
 from datetime import datetime, timezone
 import base64
 from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
-import json
+import orjson
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(
+    mongo_url,
+    # Wire compression shrinks the large extracted_data payloads; the
+    # driver negotiates down the list if the server lacks zstd
+    compressors="zstd,snappy,zlib",
+    maxPoolSize=200,
+    minPoolSize=20,
+    serverSelectionTimeoutMS=3000,
+    retryWrites=True,
+)
 db = client[os.environ.get('DB_NAME', 'finaura_db')]
 
 # Create the main app
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 api_router = APIRouter(prefix="/api")
 
+# Resolved once at import time (after load_dotenv) instead of per request
+EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY', '')
+
+_ANALYZE_PROMPT = """Analyze this bill/invoice image and extract the following information in JSON format:
+        {
+            "vendor": "vendor name",
+            "amount": total amount as number,
+            "date": "date in YYYY-MM-DD format",
+            "category": "category like groceries, utilities, shopping, food, etc",
+            "items": ["list of items if visible"],
+            "payment_method": "cash/card/upi if visible"
+        }
+
+        Respond ONLY with valid JSON, no additional text."""
+
+_CHAT_SYSTEM_MSG = """You are FinAura Bot, a helpful AI assistant for the FinAura finance app.
+        You help users navigate the app, understand their FinAura Score, manage bills, and improve their financial health.
+        Be friendly, concise, and provide actionable advice. Guide users on:
+        - How to upload bills
+        - Understanding their credit score
+        - Unlocking achievements
+        - Managing their financial data vault
+        - Financial literacy tips
+        """
+
+# Sorted by threshold so the unlock loop can stop at the first miss
+_ACHIEVEMENT_RULES = (
+    {"title": "First Step", "description": "Upload your first bill", "icon": "trophy", "points": 10, "threshold": 1},
+    {"title": "Getting Started", "description": "Upload 5 bills", "icon": "star", "points": 25, "threshold": 5},
+    {"title": "Financial Tracker", "description": "Upload 10 bills", "icon": "medal", "points": 50, "threshold": 10},
+    {"title": "Finance Master", "description": "Upload 20 bills", "icon": "crown", "points": 100, "threshold": 20},
+)
+
+# Fallback extractor for LLM replies that wrap the JSON in prose
+_JSON_BLOCK_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+# Score components precomputed over their bounded input ranges; the
+# frequency term saturates at 8 bills and the category term at 3
+_FREQ_SCORE = tuple(min(n * 5, 40) for n in range(201))
+_CAT_SCORE = tuple(min(n * 10, 30) for n in range(11))
+
+# In-process TTL caches for the dashboard's per-user polling; entries are
+# (expiry, payload) and are dropped whenever the user uploads a bill
+_CACHE_TTL_SECONDS = 30.0
+_user_cache: dict = {}
+_score_cache: dict = {}
+_cache_lock = asyncio.Lock()
+
+async def _cache_get(cache: dict, user_id: str):
+    async with _cache_lock:
+        entry = cache.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        cache.pop(user_id, None)
+        return None
+
+async def _cache_set(cache: dict, user_id: str, payload):
+    async with _cache_lock:
+        cache[user_id] = (time.monotonic() + _CACHE_TTL_SECONDS, payload)
+
+async def _cache_invalidate(user_id: str):
+    async with _cache_lock:
+        _user_cache.pop(user_id, None)
+        _score_cache.pop(user_id, None)
+
+def _get_chat(session_id: str, system_message: str) -> LlmChat:
+    """Build a configured LlmChat. Session ids are caller-generated (and
+    throwaway on the bill-analysis path), so clients are constructed per
+    call rather than cached on a key that would rarely repeat; conversation
+    state lives with the session_id, not the client object."""
+    return LlmChat(
+        api_key=EMERGENT_LLM_KEY,
+        session_id=session_id,
+        system_message=system_message
+    ).with_model("openai", "gpt-4o")
+
 # Models
 class UserProfile(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -35,19 +125,18 @@ class UserProfile(BaseModel):
     total_bills: int = 0
     total_transactions: float = 0.0
     achievements: List[str] = []
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class Bill(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
-    image_data: Optional[str] = None
     extracted_data: dict
     amount: float
     vendor: str
     date: str
     category: str
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class ScoreExplanation(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -56,7 +145,7 @@ class ScoreExplanation(BaseModel):
     score: float
     factors: List[dict]
     recommendations: List[str]
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class ChatMessage(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -64,7 +153,7 @@ class ChatMessage(BaseModel):
     session_id: str
     role: str  # user or assistant
     content: str
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class Achievement(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -75,7 +164,7 @@ class Achievement(BaseModel):
     icon: str
     points: int
     unlocked: bool = False
-    unlocked_at: Optional[str] = None
+    unlocked_at: Optional[datetime] = None
 
 class VaultAccessLog(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -84,34 +173,29 @@ class VaultAccessLog(BaseModel):
     accessor: str
     purpose: str
     granted: bool
-    timestamp: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 # Helper function to analyze bills with AI
-async def analyze_bill_image(image_base64: str) -> dict:
+async def analyze_bill_image(image_bytes: bytes) -> dict:
     try:
-        api_key = os.environ.get('EMERGENT_LLM_KEY', '')
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"bill-analysis-{uuid.uuid4()}",
-            system_message="You are a financial document analyzer. Extract bill/invoice details accurately."
-        ).with_model("openai", "gpt-4o")
-        
+        # ImageContent only speaks base64, so encode here at the last
+        # moment instead of threading a ~33%-larger string through callers.
+        # Encode in a worker thread: for multi-MB images the encode would
+        # otherwise block the event loop for tens of milliseconds
+        loop = asyncio.get_running_loop()
+        encoded = await loop.run_in_executor(None, base64.b64encode, image_bytes)
+        image_base64 = encoded.decode('ascii')
+        # Opaque per-call token; no uniqueness-across-restarts or security
+        # requirement here, so skip the urandom syscall uuid4 would make
+        chat = _get_chat(
+            f"bill-analysis-{time.monotonic_ns():x}",
+            "You are a financial document analyzer. Extract bill/invoice details accurately."
+        )
+
         image_content = ImageContent(image_base64=image_base64)
-        
-        prompt = """Analyze this bill/invoice image and extract the following information in JSON format:
-        {
-            "vendor": "vendor name",
-            "amount": total amount as number,
-            "date": "date in YYYY-MM-DD format",
-            "category": "category like groceries, utilities, shopping, food, etc",
-            "items": ["list of items if visible"],
-            "payment_method": "cash/card/upi if visible"
-        }
-        
-        Respond ONLY with valid JSON, no additional text."""
-        
+
         user_message = UserMessage(
-            text=prompt,
+            text=_ANALYZE_PROMPT,
             file_contents=[image_content]
         )
         
@@ -119,13 +203,12 @@ async def analyze_bill_image(image_base64: str) -> dict:
         
         # Parse JSON from response
         try:
-            data = json.loads(response)
-        except:
+            data = orjson.loads(response)
+        except orjson.JSONDecodeError:
             # If not valid JSON, try to extract JSON from text
-            import re
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
+            json_match = _JSON_BLOCK_RE.search(response)
             if json_match:
-                data = json.loads(json_match.group())
+                data = orjson.loads(json_match.group())
             else:
                 raise ValueError("Could not parse JSON from response")
         
@@ -137,10 +220,20 @@ async def analyze_bill_image(image_base64: str) -> dict:
 # Calculate FinAura Score
 async def calculate_finaura_score(user_id: str) -> dict:
     try:
-        # Get user's bills
-        bills = await db.bills.find({"user_id": user_id}).to_list(1000)
-        
-        if len(bills) == 0:
+        # Aggregate the user's bills server-side instead of pulling every
+        # document over the wire just to compute three scalars
+        pipeline = [
+            {"$match": {"user_id": user_id}},
+            {"$group": {
+                "_id": "$user_id",
+                "total": {"$sum": "$amount"},
+                "count": {"$sum": 1},
+                "categories": {"$addToSet": "$category"}
+            }}
+        ]
+        result = await db.bills.aggregate(pipeline).to_list(1)
+
+        if len(result) == 0:
             return {
                 "score": 50.0,
                 "factors": [
@@ -156,15 +249,16 @@ async def calculate_finaura_score(user_id: str) -> dict:
             }
         
         # Calculate score based on multiple factors
-        total_amount = sum(bill.get('amount', 0) for bill in bills)
-        num_bills = len(bills)
-        
+        stats = result[0]
+        total_amount = stats.get('total', 0)
+        num_bills = stats.get('count', 0)
+
         # Categories diversity
-        categories = set(bill.get('category', '') for bill in bills)
-        category_score = min(len(categories) * 10, 30)
-        
+        categories = stats.get('categories', [])
+        category_score = _CAT_SCORE[min(len(categories), 10)]
+
         # Bill frequency (consistency)
-        frequency_score = min(num_bills * 5, 40)
+        frequency_score = _FREQ_SCORE[min(num_bills, 200)]
         
         # Amount consistency
         avg_amount = total_amount / num_bills if num_bills > 0 else 0
@@ -224,46 +318,54 @@ async def root():
     return {"message": "FinAura API is running", "status": "active"}
 
 # User routes
-@api_router.post("/user/create")
+@api_router.post("/user/create", response_model=UserProfile)
 async def create_user(name: str, email: str):
     user = UserProfile(name=name, email=email)
     doc = user.model_dump()
     await db.users.insert_one(doc)
     return user
 
-@api_router.get("/user/{user_id}")
+@api_router.get("/user/{user_id}", response_model=None)
 async def get_user(user_id: str):
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    return user
+    user = await _cache_get(_user_cache, user_id)
+    if user is None:
+        user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        await _cache_set(_user_cache, user_id, user)
+    # Already a plain dict; skip FastAPI's recursive jsonable_encoder pass
+    return ORJSONResponse(user)
 
 @api_router.get("/user/{user_id}/score")
 async def get_user_score(user_id: str):
+    cached = await _cache_get(_score_cache, user_id)
+    if cached is not None:
+        return cached
+
     user = await db.users.find_one({"id": user_id}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    
+
     score_data = await calculate_finaura_score(user_id)
-    
+
     # Update user's score in database
     await db.users.update_one(
         {"id": user_id},
         {"$set": {"finaura_score": score_data["score"]}}
     )
-    
+
+    await _cache_set(_score_cache, user_id, score_data)
     return score_data
 
 # Bill routes
 @api_router.post("/bills/upload")
-async def upload_bill(user_id: str = Form(...), file: UploadFile = File(...)):
+async def upload_bill(background_tasks: BackgroundTasks, user_id: str = Form(...), file: UploadFile = File(...)):
     try:
         # Read image file
         contents = await file.read()
-        image_base64 = base64.b64encode(contents).decode('utf-8')
-        
+
         # Analyze with AI
-        extracted_data = await analyze_bill_image(image_base64)
+        extracted_data = await analyze_bill_image(contents)
         
         # Create bill record
         bill = Bill(
@@ -277,54 +379,54 @@ async def upload_bill(user_id: str = Form(...), file: UploadFile = File(...)):
         
         doc = bill.model_dump()
         await db.bills.insert_one(doc)
-        
-        # Update user stats
-        await db.users.update_one(
+
+        # Update user stats and read back the post-increment bill count in
+        # the same round-trip so the achievement check never sees a stale value
+        user = await db.users.find_one_and_update(
             {"id": user_id},
             {
                 "$inc": {"total_bills": 1, "total_transactions": extracted_data.get('amount', 0)}
-            }
+            },
+            return_document=ReturnDocument.AFTER,
+            projection={"total_bills": 1}
+        )
+
+        # New bill invalidates the cached profile and score
+        await _cache_invalidate(user_id)
+
+        # Check for achievements after the response is sent; the upload
+        # reply doesn't include unlocks, so don't pay for them here
+        background_tasks.add_task(
+            check_and_unlock_achievements, user_id, (user or {}).get('total_bills', 0)
         )
-        
-        # Check for achievements
-        await check_and_unlock_achievements(user_id)
         
         return {"success": True, "bill": bill, "extracted_data": extracted_data}
     except Exception as e:
         logging.error(f"Error uploading bill: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.get("/bills/{user_id}")
-async def get_user_bills(user_id: str):
-    bills = await db.bills.find({"user_id": user_id}, {"_id": 0}).to_list(1000)
-    return bills
+@api_router.get("/bills/{user_id}", response_model=None)
+async def get_user_bills(user_id: str, skip: int = 0, limit: int = 100):
+    # Paginate instead of buffering up to 1000 docs per request; newest
+    # first rides the (user_id, created_at) index
+    limit = max(1, min(limit, 100))
+    bills = await db.bills.find({"user_id": user_id}, {"_id": 0}) \
+        .sort("created_at", -1).skip(max(skip, 0)).limit(limit).to_list(limit)
+    return ORJSONResponse(bills)
 
 # Chat bot routes
 @api_router.post("/chat/message")
 async def chat_message(session_id: str, message: str, user_id: str):
     try:
-        api_key = os.environ.get('EMERGENT_LLM_KEY', '')
-        
         # Get chat history
-        history = await db.chat_messages.find({"session_id": session_id}, {"_id": 0}).sort("created_at", 1).to_list(100)
+        history = await db.chat_messages.find(
+            {"session_id": session_id},
+            {"_id": 0, "role": 1, "content": 1}
+        ).sort("created_at", 1).to_list(100)
         
         # Create chat with context
-        system_message = """You are FinAura Bot, a helpful AI assistant for the FinAura finance app. 
-        You help users navigate the app, understand their FinAura Score, manage bills, and improve their financial health.
-        Be friendly, concise, and provide actionable advice. Guide users on:
-        - How to upload bills
-        - Understanding their credit score
-        - Unlocking achievements
-        - Managing their financial data vault
-        - Financial literacy tips
-        """
-        
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=session_id,
-            system_message=system_message
-        ).with_model("openai", "gpt-4o")
-        
+        chat = _get_chat(session_id, _CHAT_SYSTEM_MSG)
+
         user_message = UserMessage(text=message)
         response = await chat.send_message(user_message)
         
@@ -332,57 +434,65 @@ async def chat_message(session_id: str, message: str, user_id: str):
         user_msg = ChatMessage(session_id=session_id, role="user", content=message)
         bot_msg = ChatMessage(session_id=session_id, role="assistant", content=response)
         
-        await db.chat_messages.insert_one(user_msg.model_dump())
-        await db.chat_messages.insert_one(bot_msg.model_dump())
+        await db.chat_messages.insert_many(
+            [user_msg.model_dump(), bot_msg.model_dump()], ordered=False
+        )
         
         return {"response": response, "session_id": session_id}
     except Exception as e:
         logging.error(f"Error in chat: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.get("/chat/history/{session_id}")
-async def get_chat_history(session_id: str):
-    messages = await db.chat_messages.find({"session_id": session_id}, {"_id": 0}).sort("created_at", 1).to_list(1000)
-    return messages
+@api_router.get("/chat/history/{session_id}", response_model=None)
+async def get_chat_history(session_id: str, limit: int = 50, before: Optional[datetime] = None):
+    # Cursor pagination: fetch the `limit` messages before `before` (or the
+    # newest ones) and return them in chronological order
+    limit = max(1, min(limit, 200))
+    query = {"session_id": session_id}
+    if before is not None:
+        query["created_at"] = {"$lt": before}
+    # Project only what the client renders; skips decoding id/session_id
+    messages = await db.chat_messages.find(
+        query,
+        {"_id": 0, "role": 1, "content": 1, "created_at": 1}
+    ).sort("created_at", -1).limit(limit).to_list(limit)
+    messages.reverse()
+    return ORJSONResponse(messages)
 
 # Achievements routes
-async def check_and_unlock_achievements(user_id: str):
-    user = await db.users.find_one({"id": user_id})
-    if not user:
-        return
-    
-    bills_count = user.get('total_bills', 0)
-    achievements_to_unlock = []
-    
-    # Define achievements
-    achievement_rules = [
-        {"title": "First Step", "description": "Upload your first bill", "icon": "trophy", "points": 10, "threshold": 1},
-        {"title": "Getting Started", "description": "Upload 5 bills", "icon": "star", "points": 25, "threshold": 5},
-        {"title": "Financial Tracker", "description": "Upload 10 bills", "icon": "medal", "points": 50, "threshold": 10},
-        {"title": "Finance Master", "description": "Upload 20 bills", "icon": "crown", "points": 100, "threshold": 20},
-    ]
-    
-    for rule in achievement_rules:
-        if bills_count >= rule['threshold']:
-            # Check if already unlocked
-            existing = await db.achievements.find_one({"user_id": user_id, "title": rule['title']})
-            if not existing:
-                achievement = Achievement(
+async def check_and_unlock_achievements(user_id: str, bills_count: int):
+    # Runs as a background task, so failures must be logged here rather
+    # than bubbling up as ASGI errors after the response has gone out
+    try:
+        # Upsert every qualifying achievement in one bulk write; $setOnInsert
+        # leaves already-unlocked ones untouched
+        unlocked_at = datetime.now(timezone.utc)
+        ops = []
+        for rule in _ACHIEVEMENT_RULES:
+            if bills_count < rule['threshold']:
+                break
+            ops.append(UpdateOne(
+                {"user_id": user_id, "title": rule['title']},
+                {"$setOnInsert": Achievement(
                     user_id=user_id,
                     title=rule['title'],
                     description=rule['description'],
                     icon=rule['icon'],
                     points=rule['points'],
                     unlocked=True,
-                    unlocked_at=datetime.now(timezone.utc).isoformat()
-                )
-                await db.achievements.insert_one(achievement.model_dump())
-                achievements_to_unlock.append(achievement)
+                    unlocked_at=unlocked_at
+                ).model_dump()},
+                upsert=True
+            ))
+        if ops:
+            await db.achievements.bulk_write(ops, ordered=False)
+    except Exception as e:
+        logging.error(f"Error unlocking achievements: {str(e)}")
 
-@api_router.get("/achievements/{user_id}")
+@api_router.get("/achievements/{user_id}", response_model=None)
 async def get_achievements(user_id: str):
     achievements = await db.achievements.find({"user_id": user_id}, {"_id": 0}).to_list(1000)
-    return achievements
+    return ORJSONResponse(achievements)
 
 # Vault routes (mocked blockchain)
 @api_router.post("/vault/grant-access")
@@ -396,10 +506,12 @@ async def grant_vault_access(user_id: str, accessor: str, purpose: str):
     await db.vault_logs.insert_one(log.model_dump())
     return {"success": True, "message": "Access granted via blockchain smart contract", "log": log}
 
-@api_router.get("/vault/logs/{user_id}")
-async def get_vault_logs(user_id: str):
-    logs = await db.vault_logs.find({"user_id": user_id}, {"_id": 0}).to_list(1000)
-    return logs
+@api_router.get("/vault/logs/{user_id}", response_model=None)
+async def get_vault_logs(user_id: str, skip: int = 0, limit: int = 100):
+    limit = max(1, min(limit, 100))
+    logs = await db.vault_logs.find({"user_id": user_id}, {"_id": 0}) \
+        .sort("timestamp", -1).skip(max(skip, 0)).limit(limit).to_list(limit)
+    return ORJSONResponse(logs)
 
 # Include router
 app.include_router(api_router)
@@ -418,6 +530,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_db_indexes():
+    # Index every hot query path so lookups stay O(log N) instead of
+    # collection scans as the data grows
+    await db.users.create_index("id", unique=True)
+    await db.bills.create_index([("user_id", 1), ("created_at", -1)])
+    # Covers the $match stage of the score aggregation
+    await db.bills.create_index([("user_id", 1), ("category", 1)])
+    # Covers the created_at sort on chat history
+    await db.chat_messages.create_index([("session_id", 1), ("created_at", 1)])
+    # Unique so the achievement bulk upserts can't double-unlock
+    await db.achievements.create_index([("user_id", 1), ("title", 1)], unique=True)
+    await db.vault_logs.create_index([("user_id", 1), ("timestamp", -1)])
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
\ No newline at end of file